@@ -1,9 +1,13 @@
+import hashlib
 import json
 import re
 import time
 import os
 import sys
+from collections import deque
 from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from itertools import chain
 
 try:
     import cloudscraper
@@ -12,6 +16,11 @@ except ImportError:
     subprocess.check_call([sys.executable, "-m", "pip", "install", "cloudscraper"])
     import cloudscraper
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 # ============================================
 # CONFIG
@@ -27,54 +36,156 @@ HARDCODED_TRAINERS = [
     "Professor Sycamore", "Raihan", "Rika", "Rosa", "Serena",
     "Shauna", "Silver", "Skyla", "Steven", "Volkner", "Volo", "Wally"
 ]
+_HARDCODED_SET = frozenset(HARDCODED_TRAINERS)
 
-SKIP_PAGES = {
+SKIP_PAGES = frozenset({
     "Trainer Lodge", "Trainer Lodge/Expeditions",
     "Trainer Lodge/Lodge Exchange", "Trainer Lodge/Redecorate"
-}
+})
+
+# Known non-trainer subpages, by name
+SKIP_NAMES = frozenset({"Expeditions", "Lodge Exchange", "Redecorate"})
 
 API_URL = "https://pokemon-masters-ex-game.fandom.com/api.php"
 
+# Cached parse results are only reused when written by this version
+SCRAPER_VERSION = "2.0"
+
 # Paths - works both locally and in GitHub Actions
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 REPO_DIR = os.path.dirname(SCRIPT_DIR)
 DATA_DIR = os.path.join(REPO_DIR, "data")
 DATA_FILE = os.path.join(DATA_DIR, "trainer_lodge_data.json")
 CHANGELOG_FILE = os.path.join(DATA_DIR, "changelog.json")
+CHANGELOG_LIMIT = 50
 
 MAX_RETRIES = 3
 RETRY_DELAY = 5
+# Consecutive non-JSON responses before the session is thrown away
+NON_JSON_REBUILD_AFTER = 2
+# Pages per batched query (MediaWiki's titles limit)
+BATCH_SIZE = 50
+MIN_REQUEST_INTERVAL = 0.1
+# Longest Retry-After we honour, so one reply can't outlast the CI job
+MAX_RETRY_AFTER = 60
+
+# Wikitext patterns, compiled once at import
+_TIER_RE = re.compile(r"===\s*(Interesting|Exciting|Super Exciting)\s*===")
+_LINE_RE = re.compile(
+    r'^[^\S\n]*(?:!colspan=["\']?\d+["\']?\|(?P<cat>.+)|\|(?P<topic>.*))$',
+    re.MULTILINE)
+_SCRAPBOOK_RE = re.compile(r"==\s*Scrapbook")
+
+
+# ============================================
+# RATE LIMITER
+# ============================================
+
+class RateLimiter:
+    # Spaces requests out. The spacing follows the server's
+    # X-RateLimit-* headers when it sends them, and a Retry-After holds
+    # every later request back until the server is ready.
+
+    def __init__(self, min_interval=MIN_REQUEST_INTERVAL):
+        self.min_interval = min_interval
+        self.interval = min_interval
+        self.next_allowed = 0.0
+
+    def acquire(self):
+        now = time.monotonic()
+        slot = max(now, self.next_allowed)
+        self.next_allowed = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def update(self, headers):
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset = headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining = int(remaining)
+            reset = float(reset)
+        except ValueError:
+            return
+
+        # Reset is an epoch timestamp; spread what is left of the window
+        window = max(reset - time.time(), 0)
+        self.interval = max(window / max(remaining, 1), self.min_interval)
+
+    def backoff(self, delay):
+        self.next_allowed = max(self.next_allowed, time.monotonic() + delay)
+
+
+def retry_after(resp, default):
+    value = resp.headers.get("Retry-After")
+    if value is None:
+        return default
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return default
+        # A "-0000" zone parses as naive; HTTP dates are always UTC
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        delay = (when - datetime.now(timezone.utc)).total_seconds()
+    if not delay > 0:
+        return 0
+    return min(delay, MAX_RETRY_AFTER)
+
+
+limiter = RateLimiter()
 
 
 # ============================================
 # HTTP REQUEST WITH RETRY
 # ============================================
 
+def create_scraper():
+    scraper = cloudscraper.create_scraper(
+        browser={"browser": "chrome", "platform": "windows", "mobile": False}
+    )
+    scraper.headers["Connection"] = "keep-alive"
+    return scraper
+
+
 def api_request(scraper, params, retries=MAX_RETRIES):
+    non_json_streak = 0
     for attempt in range(retries):
         try:
+            limiter.acquire()
             resp = scraper.get(API_URL, params=params, timeout=30)
 
             if resp.status_code != 200:
                 print("HTTP {} (attempt {}/{})".format(
                     resp.status_code, attempt + 1, retries))
                 if attempt < retries - 1:
-                    time.sleep(RETRY_DELAY * (attempt + 1))
+                    delay = RETRY_DELAY * (attempt + 1)
+                    if resp.status_code in (429, 503):
+                        delay = retry_after(resp, delay)
+                        limiter.backoff(delay)
+                    time.sleep(delay)
                 continue
 
             # Check if we got the Cloudflare challenge instead of JSON
             content_type = resp.headers.get("content-type", "")
             if "json" not in content_type:
+                non_json_streak += 1
                 print("Got non-JSON response (attempt {}/{})".format(
                     attempt + 1, retries))
                 if attempt < retries - 1:
-                    # Create new scraper instance to get fresh cookies
-                    scraper = cloudscraper.create_scraper(
-                        browser={"browser": "chrome", "platform": "windows", "mobile": False}
-                    )
+                    # A rebuild costs a new TLS handshake and challenge
+                    # solve, so only do it when a retry didn't help
+                    if non_json_streak >= NON_JSON_REBUILD_AFTER:
+                        scraper = create_scraper()
+                        non_json_streak = 0
                     time.sleep(RETRY_DELAY * (attempt + 1))
                 continue
 
+            limiter.update(resp.headers)
             data = resp.json()
             return data, scraper
 
@@ -97,10 +208,7 @@ def parse_wikitext(wikitext, trainer_name):
         "tiers": {}
     }
 
-    tier_pattern = re.compile(
-        r"===\s*(Interesting|Exciting|Super Exciting)\s*==="
-    )
-    tier_matches = list(tier_pattern.finditer(wikitext))
+    tier_matches = list(_TIER_RE.finditer(wikitext))
 
     for i, match in enumerate(tier_matches):
         tier_name = match.group(1)
@@ -109,8 +217,9 @@ def parse_wikitext(wikitext, trainer_name):
         if i + 1 < len(tier_matches):
             end = tier_matches[i + 1].start()
         else:
-            scrapbook = re.search(r"==\s*Scrapbook", wikitext[start:])
-            end = start + scrapbook.start() if scrapbook else len(wikitext)
+            # Search in place rather than on a copy of the tail
+            scrapbook = _SCRAPBOOK_RE.search(wikitext, start)
+            end = scrapbook.start() if scrapbook else len(wikitext)
 
         tier_content = wikitext[start:end]
         categories = parse_tier_content(tier_content)
@@ -125,42 +234,52 @@ def parse_tier_content(content):
     categories = {}
     current_category = None
 
-    for line in content.split("\n"):
-        line = line.strip()
-
-        if not line or line == "|-" or line == "|}" or line.startswith("{|"):
-            continue
+    # Only category headers and "|" lines can matter, so the regex skips
+    # everything else ("{|" openers, blank lines, prose) in one scan
+    for match in _LINE_RE.finditer(content):
+        cat_name = match.group("cat")
 
         # Category header: !colspan="X"|CategoryName
-        cat_match = re.match(r'!colspan=["\']?\d+["\']?\|(.+)', line)
-        if cat_match:
-            current_category = cat_match.group(1).strip()
+        if cat_name is not None:
+            cat_name = cat_name.strip()
+            if not cat_name:
+                continue
             # Normalize Pokemon variants
-            if "Pok" in current_category:
-                current_category = "Pokemon"
+            if "Pok" in cat_name:
+                cat_name = "Pokemon"
+            current_category = cat_name
             categories[current_category] = []
             continue
 
         # Topic line: |TopicName
-        if current_category and line.startswith("|") and not line.startswith("{|"):
-            raw = line[1:].strip()
+        raw = match.group("topic").rstrip()
+        if not current_category or raw == "-" or raw == "}":
+            continue
+        raw = raw.lstrip()
 
-            # Skip table formatting
-            if not raw or raw.startswith("class=") or raw.startswith("style="):
-                continue
+        # Skip table formatting
+        if not raw or raw.startswith("class=") or raw.startswith("style="):
+            continue
 
-            # Handle multiple topics: |Topic1||Topic2
-            if "||" in raw:
-                for t in raw.split("||"):
-                    t = t.strip()
-                    if t:
-                        categories[current_category].append(t)
-            else:
-                categories[current_category].append(raw)
+        # Handle multiple topics: |Topic1||Topic2
+        if "||" in raw:
+            categories[current_category].extend(
+                t for t in map(str.strip, raw.split("||")) if t)
+        else:
+            categories[current_category].append(raw)
 
     return categories
 
 
+def count_topics(tiers):
+    return sum(map(len, chain.from_iterable(
+        cats.values() for cats in tiers.values())))
+
+
+def hash_wikitext(wikitext):
+    return hashlib.blake2b(wikitext.encode("utf-8"), digest_size=16).hexdigest()
+
+
 # ============================================
 # DISCOVER NEW TRAINERS FROM WIKI CATEGORY
 # ============================================
@@ -197,31 +316,152 @@ def discover_trainers(scraper):
     return wiki_trainers, scraper
 
 
+# ============================================
+# FETCH TRAINER PAGES IN BATCHES
+# ============================================
+
+def query_batch(scraper, names, prop_params, extract):
+    # One query covers up to BATCH_SIZE trainer pages. extract() pulls the
+    # wanted value out of each page, or None if it hasn't arrived yet.
+    titles = {"Trainer Lodge/{}".format(name): name for name in names}
+    params = {
+        "action": "query",
+        "format": "json",
+        "formatversion": "2",
+        "titles": "|".join(titles)
+    }
+    params.update(prop_params)
+
+    results = {}
+    failure = "FAILED (bad response structure)"
+
+    while True:
+        data, scraper = api_request(scraper, params)
+
+        if not data:
+            failure = "FAILED (no response)"
+            break
+
+        if "error" in data:
+            failure = "API error: {}".format(data["error"].get("info", "unknown"))
+            break
+
+        query = data.get("query", {})
+
+        for norm in query.get("normalized", []):
+            if norm.get("from") in titles:
+                titles[norm.get("to")] = titles[norm["from"]]
+
+        for page in query.get("pages", []):
+            name = titles.get(page.get("title"))
+            if name is None:
+                continue
+            if page.get("missing"):
+                results[name] = (None, "FAILED (page missing)")
+                continue
+            value = extract(page)
+            # Oversized batches deliver the rest in a continuation
+            if value is not None:
+                results[name] = (value, None)
+
+        cont = data.get("continue")
+        if not cont:
+            break
+        params = dict(params, **cont)
+
+    for name in names:
+        results.setdefault(name, (None, failure))
+
+    return results, scraper
+
+
+def page_wikitext(page):
+    try:
+        return page["revisions"][0]["slots"]["main"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def fetch_revids(scraper, names):
+    return query_batch(scraper, names, {"prop": "info"},
+                       lambda page: page.get("lastrevid"))
+
+
+def fetch_batch(scraper, names):
+    params = {"prop": "revisions", "rvprop": "content", "rvslots": "main"}
+    return query_batch(scraper, names, params, page_wikitext)
+
+
+def gather_batches(scraper, fetch, names):
+    # Batches run one after another: the session isn't thread-safe, and
+    # each batch already covers BATCH_SIZE pages. Threading the scraper
+    # through means a session rebuilt by one batch is used by the next.
+    results = {}
+    for i in range(0, len(names), BATCH_SIZE):
+        batch_results, scraper = fetch(scraper, names[i:i + BATCH_SIZE])
+        results.update(batch_results)
+
+    return results, scraper
+
+
+# ============================================
+# JSON FILES
+# ============================================
+
+def read_json(path):
+    with open(path, "rb") as f:
+        if orjson is not None:
+            return orjson.loads(f.read())
+        return json.load(f)
+
+
+def write_json(path, data):
+    # Write to a temp file and swap it in, so a crash mid-write can't
+    # leave a truncated file that the next run would load as empty.
+    # Both branches write the same bytes: UTF-8, 2-space indent,
+    # trailing newline
+    tmp_path = path + ".tmp"
+    if orjson is not None:
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(
+                data, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE))
+    else:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+    os.replace(tmp_path, path)
+
+
 # ============================================
 # LOAD EXISTING DATA
 # ============================================
 
 def load_existing_data():
     if not os.path.exists(DATA_FILE):
-        return {}
+        return {}, {}
     try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        # Remove metadata key
-        return {k: v for k, v in data.items() if k != "_metadata"}
+        data = read_json(DATA_FILE)
+        # Split off metadata key
+        metadata = data.pop("_metadata", {})
+        return data, metadata
     except Exception as e:
         print("Warning: Could not load existing data: {}".format(e))
-        return {}
+        return {}, {}
 
 
 def load_changelog():
-    if not os.path.exists(CHANGELOG_FILE):
-        return {"updates": []}
-    try:
-        with open(CHANGELOG_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {"updates": []}
+    # Updates are newest first; the deque drops the oldest as new ones
+    # are pushed on the left
+    updates = []
+    changelog = {}
+    if os.path.exists(CHANGELOG_FILE):
+        try:
+            changelog = read_json(CHANGELOG_FILE)
+            updates = changelog.get("updates", [])
+        except Exception:
+            changelog = {}
+    changelog["updates"] = deque(updates[:CHANGELOG_LIMIT], maxlen=CHANGELOG_LIMIT)
+    return changelog
 
 
 # ============================================
@@ -237,10 +477,7 @@ def compare_data(old_data, new_data):
     # New trainers
     for name in sorted(new_names - old_names):
         tiers = new_data[name].get("tiers", {})
-        topic_count = sum(
-            sum(len(items) for items in cats.values())
-            for cats in tiers.values()
-        )
+        topic_count = count_topics(tiers)
         changes.append({
             "type": "new_trainer",
             "trainer": name,
@@ -259,16 +496,16 @@ def compare_data(old_data, new_data):
         old_tiers = old_data[name].get("tiers", {})
         new_tiers = new_data[name].get("tiers", {})
 
-        if json.dumps(old_tiers, sort_keys=True) == json.dumps(new_tiers, sort_keys=True):
+        if old_tiers == new_tiers:
             continue
 
         details = []
-        all_tier_names = sorted(set(list(old_tiers.keys()) + list(new_tiers.keys())))
+        all_tier_names = sorted(old_tiers.keys() | new_tiers.keys())
 
         for tier_name in all_tier_names:
             old_cats = old_tiers.get(tier_name, {})
             new_cats = new_tiers.get(tier_name, {})
-            all_cat_names = sorted(set(list(old_cats.keys()) + list(new_cats.keys())))
+            all_cat_names = sorted(old_cats.keys() | new_cats.keys())
 
             for cat_name in all_cat_names:
                 old_topics = set(old_cats.get(cat_name, []))
@@ -298,17 +535,14 @@ def compare_data(old_data, new_data):
 # SAVE DATA
 # ============================================
 
-def save_data(new_data, changes, changelog, errors):
+def save_data(new_data, changes, changelog, errors, wikitext_hashes, lastrevids):
     os.makedirs(DATA_DIR, exist_ok=True)
 
     now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
 
     # Calculate total topics
-    total_topics = 0
-    for trainer in new_data.values():
-        for cats in trainer.get("tiers", {}).values():
-            for items in cats.values():
-                total_topics += len(items)
+    total_topics = sum(
+        count_topics(trainer.get("tiers", {})) for trainer in new_data.values())
 
     # Build output with metadata first
     output = {
@@ -317,34 +551,31 @@ def save_data(new_data, changes, changelog, errors):
             "trainer_count": len(new_data),
             "total_topics": total_topics,
             "source": "pokemon-masters-ex-game.fandom.com",
-            "scraper_version": "2.0",
-            "errors": errors if errors else []
+            "scraper_version": SCRAPER_VERSION,
+            "errors": errors if errors else [],
+            "wikitext_hashes": dict(sorted(wikitext_hashes.items())),
+            "lastrevids": dict(sorted(lastrevids.items()))
         }
     }
 
     # Add trainers sorted alphabetically
-    for name in sorted(new_data.keys()):
-        output[name] = new_data[name]
+    output.update(sorted(new_data.items()))
 
     # Save main data
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(output, f, indent=2, ensure_ascii=False)
+    write_json(DATA_FILE, output)
     print("Saved: {} ({} trainers, {} topics)".format(
         DATA_FILE, len(new_data), total_topics))
 
     # Update changelog
     if changes:
-        changelog["updates"].insert(0, {
+        changelog["updates"].appendleft({
             "date": now,
             "trainer_count": len(new_data),
             "change_count": len(changes),
             "changes": changes
         })
-        # Keep last 50 entries
-        changelog["updates"] = changelog["updates"][:50]
 
-    with open(CHANGELOG_FILE, "w", encoding="utf-8") as f:
-        json.dump(changelog, f, indent=2, ensure_ascii=False)
+    write_json(CHANGELOG_FILE, dict(changelog, updates=list(changelog["updates"])))
     print("Saved: {}".format(CHANGELOG_FILE))
 
 
@@ -354,32 +585,32 @@ def save_data(new_data, changes, changelog, errors):
 
 def main():
     print("=" * 60)
-    print("POKEMON MASTERS EX - TRAINER LODGE SCRAPER v2.0")
+    print("POKEMON MASTERS EX - TRAINER LODGE SCRAPER v{}".format(SCRAPER_VERSION))
     now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M UTC")
     print("Time: {}".format(now))
     print("=" * 60)
 
     # Load existing
-    existing_data = load_existing_data()
+    existing_data, existing_meta = load_existing_data()
     changelog = load_changelog()
     print("Existing data: {} trainers".format(len(existing_data)))
 
-    # Create scraper
-    scraper = cloudscraper.create_scraper(
-        browser={"browser": "chrome", "platform": "windows", "mobile": False}
-    )
+    cached_hashes = {}
+    cached_revids = {}
+    if existing_meta.get("scraper_version") == SCRAPER_VERSION:
+        cached_hashes = existing_meta.get("wikitext_hashes", {})
+        cached_revids = existing_meta.get("lastrevids", {})
+
+    # Create scraper; the same session is reused for every request
+    scraper = create_scraper()
 
     # Discover trainers from wiki
     wiki_trainers, scraper = discover_trainers(scraper)
 
-    # Merge hardcoded + wiki discovered
-    all_trainers = sorted(set(HARDCODED_TRAINERS + wiki_trainers))
+    # Merge hardcoded + wiki discovered, minus known non-trainer pages
+    all_trainers = sorted(_HARDCODED_SET.union(wiki_trainers) - SKIP_NAMES)
 
-    # Remove known non-trainer pages
-    skip_names = {"Expeditions", "Lodge Exchange", "Redecorate"}
-    all_trainers = [t for t in all_trainers if t not in skip_names]
-
-    new_from_wiki = set(wiki_trainers) - set(HARDCODED_TRAINERS) - skip_names
+    new_from_wiki = set(wiki_trainers) - _HARDCODED_SET - SKIP_NAMES
     if new_from_wiki:
         print("\n*** NEW TRAINERS DISCOVERED: {} ***".format(
             ", ".join(sorted(new_from_wiki))))
@@ -389,57 +620,64 @@ def main():
     # Scrape
     new_data = {}
     errors = []
+    wikitext_hashes = {}
     total = len(all_trainers)
 
+    # Pages not edited since the last run keep their stored result, so
+    # their wikitext isn't downloaded at all
+    revids, scraper = gather_batches(scraper, fetch_revids, all_trainers)
+    lastrevids = {name: revid for name, (revid, _) in revids.items()
+                  if revid is not None}
+    stale = [name for name in all_trainers
+             if name not in existing_data
+             or name not in lastrevids
+             or lastrevids[name] != cached_revids.get(name)]
+    print("Fetching wikitext for {} of {} pages (the rest are unchanged)\n".format(
+        len(stale), total))
+
+    responses = {}
+    if stale:
+        responses, scraper = gather_batches(scraper, fetch_batch, stale)
+
     for i, name in enumerate(all_trainers):
+        # Fetching is already done, so each trainer gets one complete line
         pct = ((i + 1) / total) * 100
-        print("[{}/{}] ({:.0f}%) {}...".format(
-            i + 1, total, pct, name), end=" ", flush=True)
-
-        params = {
-            "action": "parse",
-            "page": "Trainer Lodge/{}".format(name),
-            "format": "json",
-            "prop": "wikitext"
-        }
+        progress = "[{}/{}] ({:.0f}%) {}...".format(i + 1, total, pct, name)
 
-        data, scraper = api_request(scraper, params)
-
-        if not data:
-            print("FAILED (no response)")
-            errors.append(name)
-            continue
+        if name not in responses:
+            wikitext_hash = cached_hashes.get(name)
+            cached = True
+        else:
+            wikitext, error_msg = responses[name]
 
-        if "error" in data:
-            error_msg = data["error"].get("info", "unknown")
-            print("API error: {}".format(error_msg))
-            errors.append(name)
-            continue
+            if error_msg:
+                print(progress, error_msg)
+                errors.append(name)
+                continue
 
-        try:
-            wikitext = data["parse"]["wikitext"]["*"]
-        except (KeyError, TypeError):
-            print("FAILED (bad response structure)")
-            errors.append(name)
-            continue
+            # Same wikitext as last run: reuse the stored result unparsed
+            wikitext_hash = hash_wikitext(wikitext)
+            cached = (wikitext_hash == cached_hashes.get(name)
+                      and name in existing_data)
 
-        trainer_result = parse_wikitext(wikitext, name)
+        if cached:
+            trainer_result = existing_data[name]
+        else:
+            trainer_result = parse_wikitext(wikitext, name)
 
         tier_count = len(trainer_result["tiers"])
-        topic_count = sum(
-            sum(len(items) for items in cats.values())
-            for cats in trainer_result["tiers"].values()
-        )
+        topic_count = count_topics(trainer_result["tiers"])
 
         if tier_count > 0:
             new_data[name] = trainer_result
-            print("OK - {} tiers, {} topics".format(tier_count, topic_count))
+            if wikitext_hash is not None:
+                wikitext_hashes[name] = wikitext_hash
+            print(progress, "OK - {} tiers, {} topics{}".format(
+                tier_count, topic_count, " (unchanged)" if cached else ""))
         else:
-            print("EMPTY (0 tiers parsed)")
+            print(progress, "EMPTY (0 tiers parsed)")
             errors.append(name)
 
-        time.sleep(0.5)
-
     # Compare
     print("\n" + "=" * 60)
     print("COMPARING DATA...")
@@ -463,7 +701,8 @@ def main():
     print("SAVING...")
     print("=" * 60)
 
-    save_data(new_data, changes, changelog, errors)
+    lastrevids = {name: lastrevids[name] for name in new_data if name in lastrevids}
+    save_data(new_data, changes, changelog, errors, wikitext_hashes, lastrevids)
 
     # Final summary
     print("\n" + "=" * 60)